@@ -0,0 +1,13 @@
+# gunicorn 启动配置（gunicorn 会自动读取当前目录下的 gunicorn.conf.py）
+# 启动命令：gunicorn main:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# 异步 I/O 型服务，少量 worker 就够；每个 worker 各有自己的连接池和打分缓存，
+# 不按 CPU 数推算（容器里拿到的是宿主机核数）。可通过 WEB_CONCURRENCY 覆盖
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+
+keepalive = 75
+timeout = 120  # 转写 + 打分最长可能要几十秒
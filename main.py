@@ -1,14 +1,75 @@
 import os
 import time
-import json
 import tempfile
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.datastructures import Headers
+from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 import httpx
+import orjson
 
-app = FastAPI()
+
+# =============== 共享 HTTP 客户端（keep-alive + HTTP/2，跨请求复用连接） ===============
+
+# AssemblyAI 和 DeepSeek 共用一个客户端；传入 transport 后 http2/limits 要配在 transport 上
+# retries 只重试建连失败（DNS/TLS 抖动），不会重发已经发出的请求
+HTTP = httpx.AsyncClient(
+    timeout=httpx.Timeout(60, connect=5),
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    ),
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 每个 worker 启动时预热一次 DeepSeek 连接，之后由连接池 keep-alive 复用
+    if DEEPSEEK_API_KEY:
+        await prewarm_deepseek(HTTP)
+    yield
+    await HTTP.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# 上传音频大小上限（约 30 秒录音）
+# 注意：没有 Content-Length 的分块上传仍会被完整收下再拒绝，
+# 真正的硬上限要在前置代理上配（Nginx client_max_body_size 3m）
+MAX_AUDIO_BYTES = 2 * 1024 * 1024
+MAX_EVALUATE_BODY_BYTES = MAX_AUDIO_BYTES + 64 * 1024  # 预留 multipart 边界和表单字段
+
+
+class EvaluateBodyLimitMiddleware:
+    # multipart 会在进入接口前被完整解析并写入临时文件，
+    # 所以要在读请求体之前按 Content-Length 提前拒绝超大上传
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/evaluate":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_EVALUATE_BODY_BYTES:
+                        response = JSONResponse(
+                            status_code=413, content={"detail": "Audio file too large"}
+                        )
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+
+# 先注册的在内层：放在 CORS 之前，413 响应也会带上 CORS 头
+app.add_middleware(EvaluateBodyLimitMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,6 +78,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class SkipNDJSONGZipMiddleware(GZipMiddleware):
+    # 请求 NDJSON 流的不压缩，否则 gzip 会把第一行缓冲到流结束才发出
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "application/x-ndjson" in Headers(scope=scope).get("accept", ""):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# 中文内容 UTF-8 体积大，压缩后对小程序的移动网络更友好
+# 阈值低于课程 JSON 的大小（约 470 字节），保证课程数据也会被压缩
+app.add_middleware(SkipNDJSONGZipMiddleware, minimum_size=256, compresslevel=5)
+
+
 # =============== 课程数据（写死一节课，和前端保持一致） ===============
 LESSON_DB = {
     "intro_001": {
@@ -44,20 +119,35 @@ LESSON_DB = {
 }
 
 
+# 课程数据是静态的，启动时序列化一次，请求时直接返回字节
+LESSON_JSON_CACHE = {
+    lesson_id: orjson.dumps(lesson)
+    for lesson_id, lesson in LESSON_DB.items()
+}
+
+
 @app.get("/lesson/{lesson_id}")
 async def get_lesson(lesson_id: str):
-    lesson = LESSON_DB.get(lesson_id)
-    if not lesson:
+    body = LESSON_JSON_CACHE.get(lesson_id)
+    if body is None:
         raise HTTPException(status_code=404, detail="Lesson not found")
-    return lesson
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"Cache-Control": "public, max-age=3600"},
+    )
+
+
+# 句子 id -> 句子，模块加载时建好索引，避免每次 /evaluate 都遍历全部课程
+SENTENCE_INDEX = {
+    s["id"]: s
+    for lesson in LESSON_DB.values()
+    for s in lesson["sentences"]
+}
 
 
 def find_sentence_by_id(sentence_id: str):
-    for lesson in LESSON_DB.values():
-        for s in lesson["sentences"]:
-            if s["id"] == sentence_id:
-                return s
-    return None
+    return SENTENCE_INDEX.get(sentence_id)
 
 
 # =============== 组装 AssemblyAI 和 DeepSeek 的配置 ===============
@@ -66,13 +156,37 @@ ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 ASSEMBLYAI_BASE_URL = "https://api.assemblyai.com/v2"
 
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_API_URL = "https://api.deepseek.com/chat/completions"
+DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+DEEPSEEK_API_URL = f"{DEEPSEEK_BASE_URL}/chat/completions"
 DEEPSEEK_MODEL = "deepseek-chat"
 
+# AssemblyAI 轮询：指数退避，短音频能更快拿到结果
+TRANSCRIBE_TIMEOUT = 30  # 最多等 30 秒
+POLL_INITIAL_DELAY = 0.2
+POLL_MAX_DELAY = 2.0
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# 上传音频格式白名单（大小上限见文件开头的 MAX_AUDIO_BYTES）
+ALLOWED_AUDIO_TYPES = {
+    "audio/mpeg",
+    "audio/mp3",
+    "audio/wav",
+    "audio/x-wav",
+    "audio/wave",
+    "audio/mp4",
+    "audio/m4a",
+    "audio/x-m4a",
+    "audio/aac",
+    "application/octet-stream",  # 小程序 uploadFile 常见的默认类型
+}
+
 
 # =============== 调用 AssemblyAI：上传音频 + 转写 ===============
 
-async def transcribe_with_assemblyai(audio_bytes: bytes) -> str:
+async def transcribe_with_assemblyai(
+    audio_chunks: AsyncIterator[bytes], client: httpx.AsyncClient
+) -> str:
     if not ASSEMBLYAI_API_KEY:
         raise RuntimeError("ASSEMBLYAI_API_KEY 未配置")
 
@@ -81,72 +195,114 @@ async def transcribe_with_assemblyai(audio_bytes: bytes) -> str:
         "content-type": "application/octet-stream",
     }
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        # 1. 上传音频
-        upload_resp = await client.post(
-            f"{ASSEMBLYAI_BASE_URL}/upload",
-            headers=headers,
-            content=audio_bytes
-        )
-        upload_resp.raise_for_status()
-        upload_url = upload_resp.json()["upload_url"]
-
-        # 2. 创建转写任务（指定西语）
-        transcript_headers = {
-            "authorization": ASSEMBLYAI_API_KEY,
-            "content-type": "application/json",
-        }
-        transcript_payload = {
-            "audio_url": upload_url,
-            "language_code": "es",  # 西班牙语
-            "punctuate": True
-        }
-        create_resp = await client.post(
-            f"{ASSEMBLYAI_BASE_URL}/transcript",
-            headers=transcript_headers,
-            json=transcript_payload
-        )
-        create_resp.raise_for_status()
-        transcript_id = create_resp.json()["id"]
+    # 1. 上传音频（分块流式发送）
+    upload_resp = await client.post(
+        f"{ASSEMBLYAI_BASE_URL}/upload",
+        headers=headers,
+        content=audio_chunks
+    )
+    upload_resp.raise_for_status()
+    upload_url = upload_resp.json()["upload_url"]
+
+    # 2. 创建转写任务（指定西语）
+    transcript_headers = {
+        "authorization": ASSEMBLYAI_API_KEY,
+        "content-type": "application/json",
+    }
+    transcript_payload = {
+        "audio_url": upload_url,
+        "language_code": "es",  # 西班牙语
+        "punctuate": True
+    }
+    create_resp = await client.post(
+        f"{ASSEMBLYAI_BASE_URL}/transcript",
+        headers=transcript_headers,
+        json=transcript_payload
+    )
+    create_resp.raise_for_status()
+    transcript_id = create_resp.json()["id"]
+
+    # 3. 轮询结果，直到完成或超时（0.2s 起步，每次 ×1.5，封顶 2s）
+    status_url = f"{ASSEMBLYAI_BASE_URL}/transcript/{transcript_id}"
+    deadline = time.monotonic() + TRANSCRIBE_TIMEOUT
+    delay = POLL_INITIAL_DELAY
+    while True:
+        status_resp = await client.get(status_url, headers=transcript_headers)
+        status_resp.raise_for_status()
+        data = status_resp.json()
+        status = data.get("status")
+        if status == "completed":
+            text = data.get("text", "").strip()
+            print("AssemblyAI 转写结果：", text)
+            return text
+        elif status == "error":
+            print("AssemblyAI 转写出错：", data.get("error"))
+            raise RuntimeError("Transcription error from AssemblyAI")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 1.5, POLL_MAX_DELAY)
+
+    raise RuntimeError("Transcription timeout")
 
-        # 3. 轮询结果，直到完成或超时
-        status_url = f"{ASSEMBLYAI_BASE_URL}/transcript/{transcript_id}"
-        for _ in range(30):  # 最多等 30 秒
-            status_resp = await client.get(status_url, headers=transcript_headers)
-            status_resp.raise_for_status()
-            data = status_resp.json()
-            status = data.get("status")
-            if status == "completed":
-                text = data.get("text", "").strip()
-                print("AssemblyAI 转写结果：", text)
-                return text
-            elif status == "error":
-                print("AssemblyAI 转写出错：", data.get("error"))
-                raise RuntimeError("Transcription error from AssemblyAI")
 
-            await asyncio.sleep(1)
+# =============== 调用 DeepSeek：根据标准句 + 用户句打分 ===============
 
-        raise RuntimeError("Transcription timeout")
+SYSTEM_PROMPT = (
+    "你是一名严格但友好的西班牙语口语老师，负责给学生的朗读打分。\n"
+    "请只用 JSON 格式回答，不要任何多余说明。\n\n"
+    "JSON 字段包括：\n"
+    "overall_score: 0-100 的整数，总分\n"
+    "accuracy: '高' 或 '中' 或 '低'，发音准确度\n"
+    "fluency: '高' 或 '中' 或 '低'，流利度\n"
+    "integrity: '高' 或 '中' 或 '低'，是否读全\n"
+    "missing_words: 漏读的单词数组\n"
+    "mispronounced_words: 可能读错的单词数组\n"
+    "suggestions: 三条简短的中文建议数组\n"
+)
 
+DEEPSEEK_HEADERS = {
+    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
+    "Content-Type": "application/json",
+}
 
-# =============== 调用 DeepSeek：根据标准句 + 用户句打分 ===============
+DEEPSEEK_BASE_PAYLOAD = {
+    "model": DEEPSEEK_MODEL,
+    "response_format": {"type": "json_object"},
+}
+
+# 打分结果 LRU 缓存：同一句话反复录、转写相同时直接复用，不再请求 DeepSeek
+GRADE_CACHE_SIZE = 2048
+GRADE_CACHE: "OrderedDict[bytes, dict]" = OrderedDict()
+
+
+def grade_cache_key(ref_text: str, user_text: str) -> bytes:
+    return hashlib.blake2b(
+        f"{ref_text}\x00{user_text}".encode("utf-8"), digest_size=16
+    ).digest()
+
+
+async def prewarm_deepseek(client: httpx.AsyncClient) -> None:
+    # 提前建好到 DeepSeek 的连接，第一次打分时省掉一次 TLS 握手；失败不影响启动
+    try:
+        await client.head(DEEPSEEK_BASE_URL, timeout=2)
+    except httpx.HTTPError as e:
+        print("DeepSeek 连接预热失败：", e)
 
-async def grade_with_deepseek(ref_text: str, user_text: str) -> dict:
+
+async def grade_with_deepseek(
+    ref_text: str, user_text: str, client: httpx.AsyncClient
+) -> dict:
     if not DEEPSEEK_API_KEY:
         raise RuntimeError("DEEPSEEK_API_KEY 未配置")
 
-    system_prompt = (
-        "你是一名严格但友好的西班牙语口语老师，负责给学生的朗读打分。\n"
-        "请只用 JSON 格式回答，不要任何多余说明。\n\n"
-        "JSON 字段包括：\n"
-        "overall_score: 0-100 的整数，总分\n"
-        "accuracy: '高' 或 '中' 或 '低'，发音准确度\n"
-        "fluency: '高' 或 '中' 或 '低'，流利度\n"
-        "integrity: '高' 或 '中' 或 '低'，是否读全\n"
-        "missing_words: 漏读的单词数组\n"
-        "mispronounced_words: 可能读错的单词数组\n"
-        "suggestions: 三条简短的中文建议数组\n"
-    )
+    cache_key = grade_cache_key(ref_text, user_text)
+    cached = GRADE_CACHE.get(cache_key)
+    if cached is not None:
+        GRADE_CACHE.move_to_end(cache_key)
+        return dict(cached)  # 返回副本，调用方会往结果里加字段
 
     user_prompt = (
         f"【标准句】：{ref_text}\n"
@@ -154,28 +310,29 @@ async def grade_with_deepseek(ref_text: str, user_text: str) -> dict:
         "请根据学生的朗读和标准句进行对比打分，输出上述 JSON。"
     )
 
-    headers = {
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-        "Content-Type": "application/json",
-    }
-
     payload = {
-        "model": DEEPSEEK_MODEL,
-        "response_format": {"type": "json_object"},
+        **DEEPSEEK_BASE_PAYLOAD,
         "messages": [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
     }
 
-    async with httpx.AsyncClient(timeout=60) as client:
-        resp = await client.post(DEEPSEEK_API_URL, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
+    resp = await client.post(
+        DEEPSEEK_API_URL,
+        headers=DEEPSEEK_HEADERS,
+        content=orjson.dumps(payload)
+    )
+    resp.raise_for_status()
+    data = resp.json()
 
     content = data["choices"][0]["message"]["content"]
-    result = json.loads(content)
-    return result
+    result = orjson.loads(content)
+
+    GRADE_CACHE[cache_key] = result
+    if len(GRADE_CACHE) > GRADE_CACHE_SIZE:
+        GRADE_CACHE.popitem(last=False)
+    return dict(result)
 
 
 # =============== /evaluate：整合 ASR + DeepSeek 的主接口 ===============
@@ -183,8 +340,17 @@ async def grade_with_deepseek(ref_text: str, user_text: str) -> dict:
 import asyncio
 
 
+async def iter_upload(file: UploadFile, first_chunk: bytes) -> AsyncIterator[bytes]:
+    # 边读边发，不把整段音频读进内存
+    chunk = first_chunk
+    while chunk:
+        yield chunk
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+
+
 @app.post("/evaluate")
 async def evaluate(
+    request: Request,
     file: UploadFile = File(...),
     sentence_id: str = Form(...)
 ):
@@ -194,29 +360,79 @@ async def evaluate(
         raise HTTPException(status_code=404, detail="Sentence not found")
     ref_text = ref_sentence["text"]
 
-    # 2. 读取音频
-    audio_bytes = await file.read()
-    if not audio_bytes:
+    # 2. 校验音频格式和大小，再读第一块判空，其余在上传时流式读取
+    #    没带 Content-Type 的按 application/octet-stream 处理并放行（有意为之：
+    #    小程序部分机型上传时不带类型），格式问题交给 AssemblyAI 报错
+    #    file.size 检查兜底没有 Content-Length 的请求
+    content_type = (file.content_type or "application/octet-stream").split(";")[0].strip().lower()
+    if content_type not in ALLOWED_AUDIO_TYPES:
+        raise HTTPException(status_code=415, detail="Unsupported audio type")
+    if file.size is not None and file.size > MAX_AUDIO_BYTES:
+        raise HTTPException(status_code=413, detail="Audio file too large")
+
+    first_chunk = await file.read(UPLOAD_CHUNK_SIZE)
+    if not first_chunk:
         raise HTTPException(status_code=400, detail="Empty audio file")
 
     # 3. AssemblyAI 转写
     try:
-        user_text = await transcribe_with_assemblyai(audio_bytes)
+        user_text = await transcribe_with_assemblyai(
+            iter_upload(file, first_chunk), client=HTTP
+        )
     except Exception as e:
         print("AssemblyAI 转写出错：", e)
         raise HTTPException(status_code=500, detail="Transcription failed")
 
     # 4. DeepSeek 打分
-    try:
-        eval_result = await grade_with_deepseek(ref_text, user_text)
-    except Exception as e:
-        print("DeepSeek 评分出错：", e)
-        raise HTTPException(status_code=500, detail="Grading failed")
-
-    eval_result["sentence_id"] = sentence_id
-    eval_result["user_text"] = user_text
-    return eval_result
+    #    默认一次性返回 JSON（小程序 uploadFile 只能拿到完整响应体）；
+    #    客户端带 Accept: application/x-ndjson 时改为流式返回
+    if "application/x-ndjson" not in request.headers.get("accept", ""):
+        try:
+            eval_result = await grade_with_deepseek(ref_text, user_text, client=HTTP)
+        except Exception as e:
+            print("DeepSeek 评分出错：", e)
+            raise HTTPException(status_code=500, detail="Grading failed")
+
+        eval_result["sentence_id"] = sentence_id
+        eval_result["user_text"] = user_text
+        return eval_result
+
+    # NDJSON 流：先推转写结果，打分完成后再推评分，每行一个 JSON，
+    # stage 为 "asr" / "grade" / "error"
+    async def stream_result():
+        yield orjson.dumps({
+            "stage": "asr",
+            "sentence_id": sentence_id,
+            "user_text": user_text,
+        }) + b"\n"
+
+        try:
+            eval_result = await grade_with_deepseek(ref_text, user_text, client=HTTP)
+        except Exception as e:
+            print("DeepSeek 评分出错：", e)
+            yield orjson.dumps({"stage": "error", "detail": "Grading failed"}) + b"\n"
+            return
+
+        eval_result["stage"] = "grade"
+        eval_result["sentence_id"] = sentence_id
+        eval_result["user_text"] = user_text
+        yield orjson.dumps(eval_result) + b"\n"
+
+    # X-Accel-Buffering 关掉 Nginx 的代理缓冲，"asr" 行才能立即到达前端
+    return StreamingResponse(
+        stream_result(),
+        media_type="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 多 worker 需要用 "main:app" 字符串形式启动；worker 数默认 4，和 gunicorn.conf.py 一致
+    # HTTP/2 由前置的 Nginx/Caddy 终结，这里保持较长的 keep-alive 方便复用连接
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "4")),
+        timeout_keep_alive=75,
+    )